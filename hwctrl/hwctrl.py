@@ -1,21 +1,23 @@
 from typing import Final, Sequence
 from types import TracebackType
 from typing_extensions import Self
-from collections.abc import Callable
+from collections.abc import Callable, Iterator
 from queue import SimpleQueue, Empty
 from concurrent.futures import ThreadPoolExecutor, Future
 from enum import auto, StrEnum
+from itertools import chain
 from gpiozero import LED, PWMOutputDevice, OutputDevice
 from time import sleep
 import sys
+import os
+import mmap
+import struct
 import threading
 import signal
 import smbus2
+from smbus2 import i2c_msg
 import gpiozero.pins.lgpio
 
-# プログラム終了フラグ
-is_terminated = False
-
 class Opcode(StrEnum):
     MOVE: Final = 'move'
     MEASURE_DISTANCE: Final = 'measure-distance'
@@ -37,27 +39,50 @@ class RaspiCarEye(StrEnum):
     RIGHT: Final = 'right',
     BOTH: Final = 'both'
 
+class InvalidCmdError(Exception):
+    """HW 制御コマンドの形式が不正であることを表す例外"""
+
+    def __init__(self, cmd_no: str, opcode: str) -> None:
+        super().__init__(f'invalid command: {cmd_no},{opcode}')
+        self.__cmd_no = cmd_no
+        self.__opcode = opcode
+
+    @property
+    def cmd_no(self) -> str:
+        return self.__cmd_no
+
+    @property
+    def opcode(self) -> str:
+        return self.__opcode
+
+
 class HwCtrlCmd:
 
     @classmethod
-    def of(cls, cmd: str):
+    def of(cls, cmd: str) -> 'HwCtrlCmd':
+        """文字列から HW 制御コマンドを作成する.
+
+        :param cmd: "コマンド番号,オペコード,パラメータ..." 形式の文字列
+        :return: オペコードに対応する HwCtrlCmd のサブクラスのオブジェクト
+        :raises InvalidCmdError: オペコードが不明な場合, もしくはパラメータが不正な場合
+        """
         fields = cmd.split(',')
         num_fields = len(fields)
         cmd_no = fields[0] if num_fields >= 1 else ''
         opcode = fields[1] if num_fields >= 2 else ''
         params = fields[2:] if num_fields >= 3 else []
-        return HwCtrlCmd(cmd_no, opcode, params)
+        cmd_class = _OPCODE_TO_CMD_CLASS.get(opcode)
+        if cmd_class is None:
+            raise InvalidCmdError(cmd_no, opcode)
+        try:
+            return cmd_class.parse(cmd_no, params)
+        except (IndexError, ValueError) as e:
+            raise InvalidCmdError(cmd_no, opcode) from e
 
-    def __init__(
-        self,
-        cmd_no: str,
-        opcode: str,
-        params: list[str] = []
-    ) -> None:
+    def __init__(self, cmd_no: str, opcode: str) -> None:
         """HW 制御コマンド"""
         self.__cmd_no = cmd_no
         self.__opcode = opcode
-        self.__params = params
 
     @property
     def cmd_no(self) -> str:
@@ -67,9 +92,105 @@ class HwCtrlCmd:
     def opcode(self) -> str:
         return self.__opcode
 
+
+class MoveCmd(HwCtrlCmd):
+
+    @classmethod
+    def parse(cls, cmd_no: str, params: list[str]) -> Self:
+        move_op = RaspiCarMoveOp(params[0])
+        if move_op == RaspiCarMoveOp.STOP:
+            return cls(cmd_no, move_op, 0, 0)
+        return cls(cmd_no, move_op, float(params[1]), float(params[2]))
+
+    def __init__(self, cmd_no: str, move_op: RaspiCarMoveOp, speed: float, time: float) -> None:
+        """移動コマンド"""
+        super().__init__(cmd_no, Opcode.MOVE)
+        self.__move_op = move_op
+        self.__speed = speed
+        self.__time = time
+
     @property
-    def params(self) -> list[str]:
-        return self.__params
+    def move_op(self) -> RaspiCarMoveOp:
+        return self.__move_op
+
+    @property
+    def speed(self) -> float:
+        return self.__speed
+
+    @property
+    def time(self) -> float:
+        return self.__time
+
+
+class MeasureDistanceCmd(HwCtrlCmd):
+
+    @classmethod
+    def parse(cls, cmd_no: str, params: list[str]) -> Self:
+        return cls(cmd_no)
+
+    def __init__(self, cmd_no: str) -> None:
+        """距離測定コマンド"""
+        super().__init__(cmd_no, Opcode.MEASURE_DISTANCE)
+
+
+class DetectColorCmd(HwCtrlCmd):
+
+    @classmethod
+    def parse(cls, cmd_no: str, params: list[str]) -> Self:
+        return cls(cmd_no, float(params[0]))
+
+    def __init__(self, cmd_no: str, exp_time: float) -> None:
+        """色取得コマンド"""
+        super().__init__(cmd_no, Opcode.DETECT_COLOR)
+        self.__exp_time = exp_time
+
+    @property
+    def exp_time(self) -> float:
+        return self.__exp_time
+
+
+class LightEyeCmd(HwCtrlCmd):
+
+    @classmethod
+    def parse(cls, cmd_no: str, params: list[str]) -> Self:
+        return cls(
+            cmd_no,
+            RaspiCarEye(params[0]),
+            bool(int(params[1])),
+            bool(int(params[2])),
+            bool(int(params[3])))
+
+    def __init__(self, cmd_no: str, eye: RaspiCarEye, red: bool, green: bool, blue: bool) -> None:
+        """目を光らせるコマンド"""
+        super().__init__(cmd_no, Opcode.LIGHT_EYE)
+        self.__eye = eye
+        self.__red = red
+        self.__green = green
+        self.__blue = blue
+
+    @property
+    def eye(self) -> RaspiCarEye:
+        return self.__eye
+
+    @property
+    def red(self) -> bool:
+        return self.__red
+
+    @property
+    def green(self) -> bool:
+        return self.__green
+
+    @property
+    def blue(self) -> bool:
+        return self.__blue
+
+
+_OPCODE_TO_CMD_CLASS: Final[dict[str, type[MoveCmd | MeasureDistanceCmd | DetectColorCmd | LightEyeCmd]]] = {
+    Opcode.MOVE:             MoveCmd,
+    Opcode.MEASURE_DISTANCE: MeasureDistanceCmd,
+    Opcode.DETECT_COLOR:     DetectColorCmd,
+    Opcode.LIGHT_EYE:        LightEyeCmd
+}
 
 
 class HwCtrlResp:
@@ -104,115 +225,180 @@ class HwCtrlResp:
         return self.__data
 
     def __str__(self):
-        res = f'{self.cmd_no},{self.is_successful},{self.opcode}'
-        for val in self.data:
-           res += ',' + val
-        return res
+        return ','.join((self.cmd_no, str(self.is_successful), self.opcode, *self.data))
+
+
+class GpioMmio:
+    """BCM283x / BCM2711 の GPIO 出力レジスタを /dev/gpiomem 経由で直接操作する.
+
+    | ピンの入出力設定と後始末は gpiozero に任せ, このクラスは出力値の書き換えのみを行う.
+    """
+    __GPSET0 = 0x1C
+    __GPCLR0 = 0x28
+    __MAP_SIZE = 4096
+
+    @classmethod
+    def open(cls) -> Self | None:
+        """GPIO レジスタをマップしたオブジェクトを返す.  使用できない環境の場合は None を返す."""
+        try:
+            with open('/proc/device-tree/compatible', 'rb') as file:
+                # Raspberry Pi 5 (BCM2712) は GPIO が RP1 にあり, レジスタの配置が異なる
+                if b'brcm,bcm2712' in file.read():
+                    return None
+            fd = os.open('/dev/gpiomem', os.O_RDWR | os.O_SYNC)
+        except OSError as e:
+            return None
+        try:
+            return cls(mmap.mmap(fd, cls.__MAP_SIZE, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE))
+        except (OSError, ValueError) as e:
+            return None
+        finally:
+            os.close(fd)
+
+    def __init__(self, mem: mmap.mmap) -> None:
+        self.__mem = mem
+
+    def write(self, set_mask: int, clr_mask: int) -> None:
+        """set_mask のビットに対応するピンを High に, clr_mask のビットに対応するピンを Low にする."""
+        if set_mask:
+            struct.pack_into('<I', self.__mem, self.__GPSET0, set_mask)
+        if clr_mask:
+            struct.pack_into('<I', self.__mem, self.__GPCLR0, clr_mask)
+
+    def close(self) -> None:
+        self.__mem.close()
 
 
 class MoveCtrl:
-    def __init__(self) -> None:
-        self.__pwm = PWMOutputDevice(12)
-        self.__lhs_phase = OutputDevice(16)
-        self.__rhs_phase = OutputDevice(26)
+    # BCM の GPIO 番号
+    __PWM_PIN = 12
+    __LHS_PHASE_PIN = 16
+    __RHS_PHASE_PIN = 26
+
+    def __init__(self, gpio: GpioMmio | None = None) -> None:
+        self.__pwm = PWMOutputDevice(self.__PWM_PIN)
+        self.__lhs_phase = OutputDevice(self.__LHS_PHASE_PIN)
+        self.__rhs_phase = OutputDevice(self.__RHS_PHASE_PIN)
+        self.__gpio = gpio
+        self.__lhs_phase_mask = 1 << self.__LHS_PHASE_PIN
+        self.__rhs_phase_mask = 1 << self.__RHS_PHASE_PIN
+        self.__last_phases: tuple[bool, bool] | None = None # 最後に設定した (左, 右) の回転方向
+        # 移動の種類 -> (左モータの回転方向, 右モータの回転方向)
+        self.__phase_table: dict[str, tuple[bool, bool]] = {
+            RaspiCarMoveOp.FORWARD:          (False, False),
+            RaspiCarMoveOp.BACKWARD:         (True,  True),
+            RaspiCarMoveOp.CLOCKWISE:        (False, True),
+            RaspiCarMoveOp.COUNTERCLOCKWISE: (True,  False)
+        }
 
     def move(self, move_op: RaspiCarMoveOp, speed: float) -> None:
         """モータを制御する"""
-        if move_op == RaspiCarMoveOp.FORWARD:
-            self.forward(speed)
-        elif move_op == RaspiCarMoveOp.BACKWARD:
-            self.backward(speed)
-        elif move_op == RaspiCarMoveOp.CLOCKWISE:
-            self.clockwise(speed)
-        elif move_op == RaspiCarMoveOp.COUNTERCLOCKWISE:
-            self.counter_clockwise(speed)
-        elif move_op == RaspiCarMoveOp.STOP:
+        if move_op == RaspiCarMoveOp.STOP:
             self.stop()
-
-    def forward(self, speed: float) -> None:
-        speed = min(1, max(speed, 0))
-        self.__lhs_phase.off()
-        self.__rhs_phase.off()
-        self.__pwm.value = speed
-
-    def backward(self, speed: float) -> None:
-        speed = min(1, max(speed, 0))
-        self.__lhs_phase.on()
-        self.__rhs_phase.on()
-        self.__pwm.value = speed
-
-    def clockwise(self, speed: float) -> None:
-        speed = min(1, max(speed, 0))
-        self.__lhs_phase.off()
-        self.__rhs_phase.on()
-        self.__pwm.value = speed
-
-    def counter_clockwise(self, speed: float) -> None:
-        speed = min(1, max(speed, 0))
-        self.__lhs_phase.on()
-        self.__rhs_phase.off()
-        self.__pwm.value = speed
+            return
+        phases = self.__phase_table.get(move_op)
+        if phases is None:
+            return
+        self.__set_phases(*phases)
+        self.__pwm.value = min(1, max(speed, 0))
 
     def stop(self) -> None:
         self.__pwm.value = 0
 
+    def __set_phases(self, lhs: bool, rhs: bool) -> None:
+        """左右のモータの回転方向を設定する.  前回と同じ場合は何もしない."""
+        if self.__last_phases == (lhs, rhs):
+            return
+        if self.__gpio is None:
+            self.__lhs_phase.value = lhs
+            self.__rhs_phase.value = rhs
+        else:
+            set_mask = (self.__lhs_phase_mask if lhs else 0) | (self.__rhs_phase_mask if rhs else 0)
+            clr_mask = (self.__lhs_phase_mask | self.__rhs_phase_mask) & ~set_mask
+            self.__gpio.write(set_mask, clr_mask)
+        self.__last_phases = (lhs, rhs)
+
 
 class CmdProcessor:
     __COLOR_SENSOR_I2C_ADDR = 0x2A
     __DISTANCE_SENSOR_I2C_ADDR = 0x57
+    __DISTANCE_MEASUREMENT_TIME = 0.2 # sec
+    # 目の LED の BCM の GPIO 番号
+    __RIGHT_EYE_PINS = {
+        'red':   23,
+        'green': 25,
+        'blue':  24
+    }
+    __LEFT_EYE_PINS = {
+        'red':   17,
+        'green': 22,
+        'blue':  27
+    }
 
     def __init__(self) -> None:
         self.__i2c1 = smbus2.SMBus(1)
         self.__i2c_lock = threading.Lock()
         self.__color_sensor_lock = threading.Lock()
+        self.__distance_sensor_lock = threading.Lock()
         self.__move_lock = threading.Lock()
         self.__num_times_moved = 0
         self.__move_event: threading.Event | None = None
-        self.__get_color_event: threading.Event | None = None
-        self.__activeCmds: set[HwCtrlCmd] = set()
-        self.__move_ctrl = MoveCtrl()
-        self.__right_eye = {
-            'red':   LED(23),
-            'green': LED(25),
-            'blue':  LED(24)
+        # 色の取得は __color_sensor_lock で排他されるので, 待機用のイベントは使いまわす
+        self.__get_color_event = threading.Event()
+        # カラーセンサの設定用メッセージ.  色の取得ごとに作り直さないように使いまわす.
+        self.__color_sensor_setup_msgs = (
+            i2c_msg.write(self.__COLOR_SENSOR_I2C_ADDR, [0, 0b10001100, 0, 0]),
+            i2c_msg.write(self.__COLOR_SENSOR_I2C_ADDR, [0, 0b00001100]))
+        self.__distance_sensor_trigger_msg = i2c_msg.write(self.__DISTANCE_SENSOR_I2C_ADDR, [0x1])
+        self.__num_active_cmds_lock = threading.Lock()
+        self.__num_active_cmds = 0 # 処理中のコマンドの数
+        self.__gpio = GpioMmio.open()
+        self.__move_ctrl = MoveCtrl(self.__gpio)
+        self.__right_eye = {color: LED(pin) for color, pin in self.__RIGHT_EYE_PINS.items()}
+        self.__left_eye = {color: LED(pin) for color, pin in self.__LEFT_EYE_PINS.items()}
+        self.__cmd_handlers: dict[str, Callable[..., HwCtrlResp]] = {
+            Opcode.DETECT_COLOR:     self.__detect_color,
+            Opcode.MOVE:             self.__move,
+            Opcode.MEASURE_DISTANCE: self.__measure_distance,
+            Opcode.LIGHT_EYE:        self.__light_eye
         }
-        self.__left_eye = {
-            'red':   LED(17),
-            'green': LED(22),
-            'blue':  LED(27)
+        self.__eye_lock = threading.Lock()
+        # 目ごとに最後に設定した (red, green, blue) の点灯状態
+        self.__last_eye_state: dict[str, tuple[bool, bool, bool] | None] = {
+            RaspiCarEye.LEFT:  None,
+            RaspiCarEye.RIGHT: None
+        }
+        self.__led_masks = {
+            eye[color]: 1 << pin
+            for eye, pins in ((self.__right_eye, self.__RIGHT_EYE_PINS), (self.__left_eye, self.__LEFT_EYE_PINS))
+            for color, pin in pins.items()
         }
 
     def process(self, cmd: HwCtrlCmd) -> HwCtrlResp:
         """引数で与えられたコマンドを処理して, その応答を返す."""
+        handler = self.__cmd_handlers.get(cmd.opcode)
+        if handler is None:
+            return HwCtrlResp(cmd.cmd_no, cmd.opcode, False)
         try:
-            self.__activeCmds.add(cmd)
-            if cmd.opcode == Opcode.DETECT_COLOR:
-                return self.__detect_color(cmd)
-            elif cmd.opcode == Opcode.MOVE:
-                return self.__move(cmd)
-            elif cmd.opcode == Opcode.MEASURE_DISTANCE:
-                return self.__measure_distance(cmd)
-            elif cmd.opcode == Opcode.LIGHT_EYE:
-                return self.__light_eye(cmd)
+            with self.__num_active_cmds_lock:
+                self.__num_active_cmds += 1
+            return handler(cmd)
         finally:
-            self.__activeCmds.remove(cmd)
-        
-        return HwCtrlResp(cmd.cmd_no, cmd.opcode, False)
+            with self.__num_active_cmds_lock:
+                self.__num_active_cmds -= 1
 
-    def __detect_color(self, cmd: HwCtrlCmd) -> HwCtrlResp:
+    def __detect_color(self, cmd: DetectColorCmd) -> HwCtrlResp:
         """色を取得するコマンドを処理する"""
         try:
-            self.__color_sensor_lock.acquire()
-            colors = self.__get_color_sensor_val(float(cmd.params[0]))
-            if colors:
-                resp_data = [str(color) for color in colors]
-                return HwCtrlResp(cmd.cmd_no, cmd.opcode, True, resp_data)
-            else:
-                return HwCtrlResp(cmd.cmd_no, cmd.opcode, False)
+            with self.__color_sensor_lock:
+                colors = self.__get_color_sensor_val(cmd.exp_time)
+                if colors:
+                    resp_data = [str(color) for color in colors]
+                    return HwCtrlResp(cmd.cmd_no, cmd.opcode, True, resp_data)
+                else:
+                    return HwCtrlResp(cmd.cmd_no, cmd.opcode, False)
         except Exception as e:
             return HwCtrlResp(cmd.cmd_no, cmd.opcode, False)
-        finally:
-            self.__color_sensor_lock.release()
 
     def __get_color_sensor_val(self, exp_time: float) -> list[int]:
         """カラーセンサー (S11059-02DT) 使って色を取得する
@@ -224,50 +410,41 @@ class CmdProcessor:
         exp_time_us = max(0, min(exp_time, max_exp_time)) * 1e6 # us
         exp_unit_time = 175 # us
         integ_val = int(exp_time_us / exp_unit_time) # 積分時間マニュアル設定レジスタの値
-        event = threading.Event()
+        self.__get_color_event.clear()
+        # 積分時間マニュアル設定レジスタの値だけを書き換える
+        self.__color_sensor_setup_msgs[0].buf[2] = bytes((integ_val >> 8,))
+        self.__color_sensor_setup_msgs[0].buf[3] = bytes((integ_val & 0xFF,))
         try:
-            self.__i2c_lock.acquire()
-            self.__i2c1.write_byte_data(self.__COLOR_SENSOR_I2C_ADDR, 0, 0b10001100)
-            self.__i2c1.write_byte_data(self.__COLOR_SENSOR_I2C_ADDR, 1, integ_val >> 8)
-            self.__i2c1.write_byte_data(self.__COLOR_SENSOR_I2C_ADDR, 2, integ_val & 0xFF)
-            self.__i2c1.write_byte_data(self.__COLOR_SENSOR_I2C_ADDR, 0, 0b00001100)
-            self.__get_color_event = event
+            with self.__i2c_lock:
+                # レジスタ 0 ~ 2 の設定 (リセット + 積分時間) と測定開始を 1 回の転送で行う
+                self.__i2c1.i2c_rdwr(*self.__color_sensor_setup_msgs)
         except Exception as e:
             return []
-        finally:
-            self.__i2c_lock.release()
         
-        event.wait((4 * exp_time) * 1.05) # red, green, blue, infrared の露光時間分待つ
+        # red, green, blue, infrared の露光時間分待つ.  積分時間が 0 の場合は待つ必要がない.
+        if integ_val > 0:
+            self.__get_color_event.wait((4 * exp_time) * 1.05)
 
         try:
-            self.__i2c_lock.acquire()
-            color_vals = self.__i2c1.read_i2c_block_data(self.__COLOR_SENSOR_I2C_ADDR, 3, 8)
+            with self.__i2c_lock:
+                color_vals = self.__i2c1.read_i2c_block_data(self.__COLOR_SENSOR_I2C_ADDR, 3, 6) # 赤外は使わないので読まない
         except Exception as e:
             return []
-        finally:
-            self.__i2c_lock.release()
 
-        return [
-            color_vals[0] << 8 | color_vals[1],
-            color_vals[2] << 8 | color_vals[3],
-            color_vals[4] << 8 | color_vals[5]]
+        return list(struct.unpack('>HHH', bytes(color_vals)))
 
     def __cancel_color_detection(self) -> None:
         """色の取得をキャンセルする"""
-        if self.__get_color_event is not None:
-            self.__get_color_event.set()
+        self.__get_color_event.set()
 
-    def __move(self, cmd: HwCtrlCmd) -> HwCtrlResp:
+    def __move(self, cmd: MoveCmd) -> HwCtrlResp:
         """移動コマンドを処理する"""
         success = False
         try:
-            move_op = RaspiCarMoveOp(cmd.params[0])
-            if move_op == RaspiCarMoveOp.STOP:
+            if cmd.move_op == RaspiCarMoveOp.STOP:
                 success = self.__stop_raspicar()
             else:
-                speed = float(cmd.params[1])
-                time = float(cmd.params[2])
-                success = self.__move_raspicar(move_op, speed, time)
+                success = self.__move_raspicar(cmd.move_op, cmd.speed, cmd.time)
         except Exception as e:
             pass
         
@@ -283,29 +460,28 @@ class CmdProcessor:
         """
         event = threading.Event()
         try:
-            self.__move_lock.acquire()
-            self.__num_times_moved += 1
-            num_times_moved = self.__num_times_moved
-            self.__move_ctrl.move(move_op, speed)
-            self.__cancel_move()
-            self.__move_event = event
+            with self.__move_lock:
+                self.__num_times_moved += 1
+                num_times_moved = self.__num_times_moved
+                self.__move_ctrl.move(move_op, speed)
+                prev_event = self.__move_event
+                self.__move_event = event
         except Exception as e:
             return False
-        finally:
-            self.__move_lock.release()
 
+        # 待機中のスレッドが起床直後に __move_lock で待たされないように, ロックの解放後に通知する.
+        if prev_event is not None:
+            prev_event.set()
         event.wait(time)
 
         try:
-            self.__move_lock.acquire()
-            # wait 中に別の移動コマンドがあった場合, 停止処理は行わない.
-            if num_times_moved != self.__num_times_moved:
-                return True
-            self.__move_ctrl.stop()
+            with self.__move_lock:
+                # wait 中に別の移動コマンドがあった場合, 停止処理は行わない.
+                if num_times_moved != self.__num_times_moved:
+                    return True
+                self.__move_ctrl.stop()
         except Exception as e:
             return False
-        finally:
-            self.__move_lock.release()
 
         return True
     
@@ -315,14 +491,15 @@ class CmdProcessor:
         :return: True: 成功, False: 失敗
         """
         try:
-            self.__move_lock.acquire()
-            self.__num_times_moved += 1
-            self.__move_ctrl.stop()
-            self.__cancel_move()
+            with self.__move_lock:
+                self.__num_times_moved += 1
+                self.__move_ctrl.stop()
+                prev_event = self.__move_event
         except Exception as e:
             return False
-        finally:
-            self.__move_lock.release()
+
+        if prev_event is not None:
+            prev_event.set()
         return True
 
     def __cancel_move(self) -> None:
@@ -330,51 +507,81 @@ class CmdProcessor:
         if self.__move_event is not None:
             self.__move_event.set()
 
-    def __measure_distance(self, cmd: HwCtrlCmd) -> HwCtrlResp:
+    def __measure_distance(self, cmd: MeasureDistanceCmd) -> HwCtrlResp:
         """HCSR-04 を使って距離を測定する."""
-        try:
-            self.__i2c_lock.acquire()
-            self.__i2c1.write_byte(self.__DISTANCE_SENSOR_I2C_ADDR, 0x1)
-            sleep(0.2)
-            data = self.__i2c1.read_i2c_block_data(self.__DISTANCE_SENSOR_I2C_ADDR, 0, 3)
-            distance = (data[0] << 16 | data[1] << 8 | data[2])  # um
-            return HwCtrlResp(cmd.cmd_no, cmd.opcode, True, [str(distance)])
-        except Exception as e:
-            return HwCtrlResp(cmd.cmd_no, cmd.opcode, False)
-        finally:
-            self.__i2c_lock.release()
+        # 測定開始から読み出しまでは __distance_sensor_lock で排他する.
+        # 測定の完了を待つ間は他のコマンドが I2C バスを使えるように, __i2c_lock は転送ごとに取る.
+        with self.__distance_sensor_lock:
+            try:
+                with self.__i2c_lock:
+                    self.__i2c1.i2c_rdwr(self.__distance_sensor_trigger_msg)
+            except Exception as e:
+                return HwCtrlResp(cmd.cmd_no, cmd.opcode, False)
+
+            # 測定完了を確実に検出する方法が確認できていないので, 実機で動作実績のある固定時間だけ待つ.
+            sleep(self.__DISTANCE_MEASUREMENT_TIME)
+            try:
+                with self.__i2c_lock:
+                    read = i2c_msg.read(self.__DISTANCE_SENSOR_I2C_ADDR, 3)
+                    self.__i2c1.i2c_rdwr(read)
+            except Exception as e:
+                return HwCtrlResp(cmd.cmd_no, cmd.opcode, False)
 
-    def __light_eye(self, cmd: HwCtrlCmd) -> HwCtrlResp:
+        distance = int.from_bytes(bytes(read), 'big')  # um
+        return HwCtrlResp(cmd.cmd_no, cmd.opcode, True, [str(distance)])
+
+    def __light_eye(self, cmd: LightEyeCmd) -> HwCtrlResp:
         """RaspiCar の目を光らせる."""
         try:
-            eye = cmd.params[0]
-            red = bool(int(cmd.params[1]))
-            green = bool(int(cmd.params[2]))
-            blue = bool(int(cmd.params[3]))
-            if eye == RaspiCarEye.LEFT or eye == RaspiCarEye.BOTH:
-                self.__light_leds({
-                    self.__left_eye['red']:   red,
-                    self.__left_eye['green']: green,
-                    self.__left_eye['blue']:  blue
-                })
-            if eye == RaspiCarEye.RIGHT or eye == RaspiCarEye.BOTH:
-                self.__light_leds({
-                    self.__right_eye['red']:   red,
-                    self.__right_eye['green']: green,
-                    self.__right_eye['blue']:  blue
-                })
+            eye = cmd.eye
+            red = cmd.red
+            green = cmd.green
+            blue = cmd.blue
+            state = (red, green, blue)
+            with self.__eye_lock:
+                # 前回と同じ色の場合は LED の出力を変えない
+                if ((eye == RaspiCarEye.LEFT or eye == RaspiCarEye.BOTH)
+                        and self.__last_eye_state[RaspiCarEye.LEFT] != state):
+                    self.__light_leds({
+                        self.__left_eye['red']:   red,
+                        self.__left_eye['green']: green,
+                        self.__left_eye['blue']:  blue
+                    })
+                    self.__last_eye_state[RaspiCarEye.LEFT] = state
+                if ((eye == RaspiCarEye.RIGHT or eye == RaspiCarEye.BOTH)
+                        and self.__last_eye_state[RaspiCarEye.RIGHT] != state):
+                    self.__light_leds({
+                        self.__right_eye['red']:   red,
+                        self.__right_eye['green']: green,
+                        self.__right_eye['blue']:  blue
+                    })
+                    self.__last_eye_state[RaspiCarEye.RIGHT] = state
             return HwCtrlResp(cmd.cmd_no, cmd.opcode, True)
         except Exception as e:
             return HwCtrlResp(cmd.cmd_no, cmd.opcode, False)
     
-    @classmethod
-    def __light_leds(cls, led_to_flag: dict[LED, bool]) -> None:
+    def __light_leds(self, led_to_flag: dict[LED, bool]) -> None:
+        if self.__gpio is None:
+            for led, flag in led_to_flag.items():
+                if flag:
+                    led.on()
+                else:
+                    led.off()
+            return
+
+        set_mask = 0
+        clr_mask = 0
         for led, flag in led_to_flag.items():
             if flag:
-
-                led.on()
+                set_mask |= self.__led_masks[led]
             else:
-                led.off()
+                clr_mask |= self.__led_masks[led]
+        self.__gpio.write(set_mask, clr_mask)
+
+    def __get_num_active_cmds(self) -> int:
+        """処理中のコマンドの数を返す"""
+        with self.__num_active_cmds_lock:
+            return self.__num_active_cmds
 
     def __enter__(self) -> Self:
         return self
@@ -395,75 +602,152 @@ class CmdProcessor:
 
         """
         count = 0
-        while len(self.__activeCmds) != 0 and count < 15:
+        while self.__get_num_active_cmds() != 0 and count < 15:
             count += 1
             self.__cancel_move()
             self.__cancel_color_detection()
             sleep(0.1)
-        for led in list(self.__right_eye.values()) + list(self.__right_eye.values()):
+        for led in chain(self.__right_eye.values(), self.__left_eye.values()):
             led.off()
 
         self.__i2c1.close()
+        if self.__gpio is not None:
+            self.__gpio.close()
 
 def on_killed(signum, frame) -> None:
     sys.exit(1)
 
-def close(processor: CmdProcessor, futures: Sequence[Future]) -> None:
-    """プログラムの終了処理を行う"""
-    # スレッド停止
-    global is_terminated
-    is_terminated = True
-    # HW のクロージング
-    processor.close()
-    # スレッド停止待ち
-    for future in futures:
-        future.result()
-
-def output_fifo_elems(fifo: SimpleQueue[HwCtrlResp]) -> None:
-    """FIFO の要素を標準出力に出力し続ける"""
-    while not is_terminated:
-        try:
-            resp = str(fifo.get(timeout = 0.1))
-            sys.stdout.write(resp + '\n')
-            sys.stdout.flush()
-        except Empty:
-            pass
+def close(
+    processor: CmdProcessor,
+    workers: Sequence[tuple[SimpleQueue[HwCtrlCmd | None], Future]],
+    resp_fifo: SimpleQueue[HwCtrlResp | None],
+    output_future: Future | None) -> None:
+    """プログラムの終了処理を行う
+
+    :param workers: (ワーカースレッドがコマンドを取り出す FIFO, ワーカースレッドの Future) のリスト
+    """
+    # 未処理のコマンドを破棄して, ワーカースレッドに停止を通知する
+    for cmd_fifo, _ in workers:
+        while True:
+            try:
+                cmd_fifo.get_nowait()
+            except Empty:
+                break
+    for cmd_fifo, _ in workers:
+        cmd_fifo.put(None)
+    try:
+        # HW のクロージング
+        processor.close()
+        # スレッド停止待ち
+        for _, future in workers:
+            future.result()
+    finally:
+        # ワーカースレッドが例外で終了していても出力スレッドは必ず停止させる
+        resp_fifo.put(None)
+        if output_future is not None:
+            output_future.result()
+
+def pin_to_cpu(core_index: int) -> None:
+    """呼び出し元のスレッドを, 使用可能な CPU コアのうち core_index 番目のものに固定する.
+
+    | 使用可能なコアが core_index 番目まで無い場合は固定しない.
+    | 固定できないスレッドを他のスレッドと同じコアに固定すると, スケジューラがコアを移せなくなるためである.
+
+    :param core_index: 使用可能なコアの中でのインデックス (0 ~)
+    """
+    cpus = sorted(os.sched_getaffinity(0))
+    if len(cpus) <= 1 or core_index >= len(cpus):
+        return
+    try:
+        os.sched_setaffinity(0, {cpus[core_index]})
+    except OSError as e:
+        pass
+
+def output_fifo_elems(fifo: SimpleQueue[HwCtrlResp | None]) -> None:
+    """FIFO の要素を標準出力に出力し続ける. None を受け取ると終了する."""
+    pin_to_cpu(0)
+    out = sys.stdout.buffer
+    while True:
+        resps = [fifo.get()]
+        # 溜まっている応答をまとめて 1 回で書き出す
+        while True:
+            try:
+                resps.append(fifo.get_nowait())
+            except Empty:
+                break
+        end = resps.index(None) if None in resps else len(resps)
+        out.writelines([str(resp).encode() + b'\n' for resp in resps[:end]])
+        out.flush()
+        if end != len(resps):
+            return
 
 def process_cmds(
     processor: CmdProcessor,
-    cmd_fifo: SimpleQueue[HwCtrlCmd],
-    resp_fifo: SimpleQueue[HwCtrlResp]) -> None:
-    """コマンドを処理し続ける."""
-    while not is_terminated:
-        try:
-            cmd = cmd_fifo.get(timeout = 0.1)
-            resp = processor.process(cmd)
-            resp_fifo.put(resp)
-        except Empty:
-            pass
+    cmd_fifo: SimpleQueue[HwCtrlCmd | None],
+    resp_fifo: SimpleQueue[HwCtrlResp | None],
+    core_index: int) -> None:
+    """コマンドを処理し続ける. None を受け取ると終了する.
+
+    :param core_index: このスレッドを固定する CPU コアのインデックス.  詳細は pin_to_cpu を参照.
+    """
+    pin_to_cpu(core_index)
+    while (cmd := cmd_fifo.get()) is not None:
+        resp = processor.process(cmd)
+        resp_fifo.put(resp)
+
+def read_lines(fd: int) -> Iterator[str]:
+    """ファイルディスクリプタからまとめて読み出したデータを行ごとに分けて返す.
+
+    :param fd: 読み出し元のファイルディスクリプタ
+    :return: 改行文字を除いた各行の文字列を返すイテレータ
+    """
+    leftover = b''
+    while chunk := os.read(fd, 4096):
+        lines = (leftover + chunk).split(b'\n')
+        leftover = lines.pop()
+        for line in lines:
+            yield line.decode()
+    if leftover:
+        yield leftover.decode()
 
 def main():
-    num_workers = 6
+    # I2C を使うコマンドと GPIO を使うコマンドで FIFO とワーカースレッドを分ける.
+    # 移動中に次の移動コマンドで割り込めるように, 各 FIFO に 2 スレッドずつ割り当てる.
+    num_workers_per_fifo = 2
     processor = CmdProcessor()
     signal.signal(signal.SIGTERM, on_killed)
-    futures = []
-    with (ThreadPoolExecutor(max_workers=num_workers) as executor):
+    i2c_fifo = SimpleQueue()
+    gpio_fifo = SimpleQueue()
+    resp_fifo = SimpleQueue()
+    opcode_to_fifo: dict[str, SimpleQueue[HwCtrlCmd | None]] = {
+        Opcode.MEASURE_DISTANCE: i2c_fifo,
+        Opcode.DETECT_COLOR:     i2c_fifo,
+        Opcode.MOVE:             gpio_fifo,
+        Opcode.LIGHT_EYE:        gpio_fifo
+    }
+    workers = []
+    output_future = None
+    with (ThreadPoolExecutor(max_workers=2 * num_workers_per_fifo + 1) as executor):
         try:
-            cmd_fifo = SimpleQueue()
-            resp_fifo = SimpleQueue()
-            futures = [
-                executor.submit(process_cmds, processor, cmd_fifo, resp_fifo)
-                for _ in range(num_workers - 1) ]
-            futures.append(executor.submit(output_fifo_elems, resp_fifo))
-            for line in sys.stdin:
-                data = line.rstrip('\n')
+            # コア 0 は出力用のスレッドが使い, FIFO ごとにワーカースレッドを別のコアに固定する.
+            for core_index, cmd_fifo in ((1, i2c_fifo), (2, gpio_fifo)):
+                for _ in range(num_workers_per_fifo):
+                    future = executor.submit(
+                        process_cmds, processor, cmd_fifo, resp_fifo, core_index)
+                    workers.append((cmd_fifo, future))
+            output_future = executor.submit(output_fifo_elems, resp_fifo)
+            for data in read_lines(sys.stdin.fileno()):
                 if data == 'terminate':
                     break
-                cmd_fifo.put(HwCtrlCmd.of(data))
+                try:
+                    cmd = HwCtrlCmd.of(data)
+                    opcode_to_fifo[cmd.opcode].put(cmd)
+                except InvalidCmdError as e:
+                    resp_fifo.put(HwCtrlResp(e.cmd_no, e.opcode, False))
         finally:
             signal.signal(signal.SIGTERM, signal.SIG_IGN)
             signal.signal(signal.SIGINT, signal.SIG_IGN)
-            close(processor, futures)
+            close(processor, workers, resp_fifo, output_future)
             signal.signal(signal.SIGTERM, signal.SIG_DFL)
             signal.signal(signal.SIGINT, signal.SIG_DFL)
 